@@ -1,50 +1,214 @@
+import io
+import atexit
 import os
-import json
+import re
 import time
 import random
+import sqlite3
+import tarfile
+import threading
 import datetime as dt
+import orjson
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "").strip()
 SEC_USER_AGENT = os.getenv("SEC_USER_AGENT", "").strip()
 
-DB_PATH = "insider_db.json"
+DB_PATH = "insider_db.sqlite"
+LEGACY_DB_PATH = "insider_db.json"  # senas JSON formatas, importuojam vieną kartą
 
-# Greičio kontrolė
-MIN_SLEEP_BETWEEN_REQUESTS = 0.35  # sekundės
-MAX_SLEEP_BETWEEN_REQUESTS = 0.75  # sekundės
+# Kiek matytų accession laikom DB
+SEEN_LIMIT = 2500
+
+# Greičio kontrolė: SEC leidžia iki 10 req/s, laikomės šiek tiek žemiau
+SEC_MAX_RPS = 9.0
+SEC_MIN_RPS = 1.0
+RPS_STEP = 0.5  # kiek pridedam po sėkmingos greitos užklausos
+LATENCY_TARGET = 1.0  # sekundės; lėtesni atsakymai greičio nekelia
 
 # Retry kontrolė
 MAX_RETRIES = 6
 BASE_BACKOFF = 1.2  # sekundės
 MAX_BACKOFF = 45.0  # sekundės
 
+# Lygiagretumas: kiek filingų apdorojam vienu metu
+MAX_WORKERS = 8
+
 # Saugikliai, kad vienas run nebūtų per sunkus SEC
 MAX_NEW_FILINGS_TO_PROCESS = 30  # mažink/didink pagal poreikį
 
+# Atsakymų dydžio ribos (baitais): patologiškus filingus praleidžiam
+SUBMISSION_MAX_BYTES = 2 * 1024 * 1024
+INDEX_JSON_MAX_BYTES = 256 * 1024
+FORM4_XML_MAX_BYTES = 1024 * 1024
+
+# Bulk režimas: vietoj Atom feed skenuojam visą praėjusios darbo dienos SEC
+# archyvą (Archives/edgar/Feed/.../YYYYMMDD.nc.tar.gz) - viena užklausa, bet
+# didelis failas. Tinka backfill'ui / kartą per dieną; realtime lieka feed'as.
+USE_BULK = False
+
+# Telegram žinutės riba 4096 simboliai, paliekam atsargos
+TELEGRAM_MAX_LEN = 4000
+
 # Paprastas filtras
 ONLY_PURCHASES = True
 
 
-def load_db():
-    if not os.path.exists(DB_PATH):
-        return {"seen_accessions": [], "last_run_utc": None}
+def open_db():
+    """
+    SQLite DB su WAL: seen paieška per indeksą, įrašymas inkrementinis,
+    nereikia kiekvieną run perrašyti viso failo.
+    """
+    con = sqlite3.connect(DB_PATH)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    # 64 MiB page cache + mmap, kad seen paieška liktų atmintyje augant lentelei.
+    # Ilgai veikiančiam DB: "PRAGMA auto_vacuum=INCREMENTAL; VACUUM;" vieną kartą,
+    # vėliau "PRAGMA incremental_vacuum;" grąžina laisvus puslapius po prune_seen.
+    con.executescript(
+        "PRAGMA cache_size=-65536;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA mmap_size=268435456;"
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS seen (accession TEXT PRIMARY KEY, ts TEXT)")
+    con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    # Jau parsinti, bet dar nepažymėti seen filingai (jei run nutrūko pusiaukelėj)
+    con.execute("CREATE TABLE IF NOT EXISTS parsed (accession TEXT PRIMARY KEY, payload BLOB)")
+    import_legacy_db(con)
+    return con
+
+
+def import_legacy_db(con):
+    """
+    Jei DB dar tuščia, perkeliam seen_accessions iš seno insider_db.json.
+    """
+    if not os.path.exists(LEGACY_DB_PATH):
+        return
+    if con.execute("SELECT 1 FROM seen LIMIT 1").fetchone():
+        return
     try:
-        with open(DB_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(LEGACY_DB_PATH, "rb") as f:
+            legacy = orjson.loads(f.read())
     except Exception:
-        return {"seen_accessions": [], "last_run_utc": None}
+        return
+    con.executemany(
+        "INSERT OR IGNORE INTO seen (accession, ts) VALUES (?, ?)",
+        [(acc, legacy.get("last_run_utc")) for acc in legacy.get("seen_accessions", [])]
+    )
+    con.commit()
+
+
+def seen_among(con, accessions):
+    """
+    Vienu SELECT grąžina set'ą tų accession, kurie jau matyti.
+    """
+    accessions = list(accessions)
+    found = set()
+    # SQLite riboja parametrų skaičių užklausoje, todėl dalinam po 500
+    for i in range(0, len(accessions), 500):
+        part = accessions[i:i + 500]
+        marks = ",".join("?" * len(part))
+        rows = con.execute(f"SELECT accession FROM seen WHERE accession IN ({marks})", part)
+        found.update(row[0] for row in rows)
+    return found
+
+
+def mark_seen(con, accession, ts):
+    con.execute("INSERT OR IGNORE INTO seen (accession, ts) VALUES (?, ?)", (accession, ts))
+
+
+def prune_seen(con, keep=SEEN_LIMIT):
+    con.execute(
+        "DELETE FROM seen WHERE rowid NOT IN (SELECT rowid FROM seen ORDER BY rowid DESC LIMIT ?)",
+        (keep,)
+    )
 
 
-def save_db(db):
-    with open(DB_PATH, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+def get_meta(con, key):
+    row = con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
 
 
-def jitter_sleep(min_s=MIN_SLEEP_BETWEEN_REQUESTS, max_s=MAX_SLEEP_BETWEEN_REQUESTS):
-    time.sleep(random.uniform(min_s, max_s))
+def set_meta(con, key, value):
+    con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def cache_parsed(con, accession, items):
+    """
+    Išsaugom filingo rezultatą iškart (su commit), kad nutrūkus run nereikėtų jo siųstis iš naujo.
+    """
+    con.execute(
+        "INSERT OR REPLACE INTO parsed (accession, payload) VALUES (?, ?)",
+        (accession, orjson.dumps(items))
+    )
+    con.commit()
+
+
+def parsed_pending(con):
+    """
+    Filingai, kurie praeitą kartą buvo parsinti, bet run nespėjo jų pažymėti seen.
+    Grąžina dict: accession -> list[item].
+    """
+    rows = con.execute(
+        "SELECT accession, payload FROM parsed WHERE accession NOT IN (SELECT accession FROM seen)"
+    )
+    return {acc: orjson.loads(payload) for acc, payload in rows}
+
+
+def drop_parsed_seen(con):
+    con.execute("DELETE FROM parsed WHERE accession IN (SELECT accession FROM seen)")
+
+
+class RateLimiter:
+    """
+    Token bucket: vidutiniškai ne daugiau nei `rate` užklausų per sekundę.
+    Bendras visiems thread'ams, todėl lygiagretūs fetch'ai neviršija SEC limito.
+
+    Greitis reguliuojamas AIMD principu: sėkminga greita užklausa prideda
+    `step` (iki `max_rate`), 429/5xx greitį perpus sumažina (iki `min_rate`)
+    ir, jei SEC nurodė Retry-After, pristabdo visus thread'us.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=SEC_MIN_RPS, step=RPS_STEP):
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.step = float(step)
+        self.rate = self.max_rate
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait_s = (1.0 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+    def on_success(self, latency):
+        if latency > LATENCY_TARGET:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    def on_throttle(self, pause=0.0):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            # "skola" bucket'e: visi thread'ai palauks ~pause sekundžių
+            self.tokens = min(self.tokens, -pause * self.rate)
+
+
+SEC_LIMITER = RateLimiter(SEC_MAX_RPS)
 
 
 def sec_headers():
@@ -59,21 +223,51 @@ def sec_headers():
     }
 
 
-def sec_get(url, timeout=30):
+def make_session():
+    """
+    Viena bendra sesija: keep-alive jungtys į sec.gov ir api.telegram.org
+    naudojamos pakartotinai, be naujo TCP+TLS handshake kiekvienai užklausai.
+    """
+    s = requests.Session()
+    # SEC antraščių (User-Agent su kontaktu) sesijai nededam - jos siunčiamos
+    # tik SEC užklausose per sec_get, o ne į Telegram
+    # Hostų mažai (sec.gov, telegram), bet jungčių pool'as didesnis nei MAX_WORKERS.
+    # Retry daro pats sec_get, todėl adapteris nekartoja.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+SESSION = make_session()
+atexit.register(SESSION.close)
+
+
+def sec_get(url, timeout=30, headers=None, stream=False, ok_statuses=(200, 304)):
     """
     Patikimas GET su retry/backoff ant 429/5xx.
+    304 (conditional GET) irgi laikomas sėkme - tikrina kviečiantysis.
+    ok_statuses: statusai, grąžinami iškart be retry (pvz. 404 dienos archyvui).
     """
+    req_headers = sec_headers()
+    if headers:
+        req_headers.update(headers)
+
     last_err = None
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            jitter_sleep()
-            r = requests.get(url, headers=sec_headers(), timeout=timeout)
+            SEC_LIMITER.acquire()
+            t0 = time.monotonic()
+            r = SESSION.get(url, timeout=timeout, headers=req_headers, stream=stream)
 
-            if r.status_code == 200:
+            if r.status_code in ok_statuses:
+                SEC_LIMITER.on_success(time.monotonic() - t0)
                 return r
 
             # Jei 429 arba laikini 5xx, darom backoff
             if r.status_code in (429, 500, 502, 503, 504):
+                # stream=True atveju jungtis kitaip liktų paimta iš pool'o iki GC
+                r.close()
                 ra = r.headers.get("Retry-After")
                 if ra:
                     try:
@@ -84,9 +278,11 @@ def sec_get(url, timeout=30):
                     wait_s = BASE_BACKOFF * (2 ** (attempt - 1))
 
                 wait_s = min(wait_s, MAX_BACKOFF)
+                SEC_LIMITER.on_throttle(wait_s if ra else 0.0)
                 time.sleep(wait_s + random.uniform(0.0, 0.8))
                 continue
 
+            r.close()
             r.raise_for_status()
 
         except Exception as e:
@@ -100,236 +296,612 @@ def sec_get(url, timeout=30):
     raise RuntimeError("SEC request failed without exception")
 
 
+def sec_get_bytes(url, max_bytes, timeout=30):
+    """
+    sec_get su dydžio riba: kūną skaitom srautu ir nutraukiam, vos viršijus
+    max_bytes. Per didelis atsakymas -> None (kviečiantysis nusprendžia, ką daryti).
+    Kūnas skaitomas jau grįžus iš sec_get, todėl nutrūkusį perdavimą
+    (connection reset, read timeout) kartojam čia su tuo pačiu backoff.
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        r = sec_get(url, timeout=timeout, stream=True)
+        try:
+            with r:
+                length = r.headers.get("Content-Length", "")
+                if length.isdigit() and int(length) > max_bytes:
+                    return None
+                body = bytearray()
+                for chunk in r.iter_content(64 * 1024):
+                    body += chunk
+                    if len(body) > max_bytes:
+                        return None
+                return bytes(body)
+        except requests.exceptions.RequestException:
+            if attempt == MAX_RETRIES:
+                raise
+            SEC_LIMITER.on_throttle()
+            wait_s = min(BASE_BACKOFF * (2 ** (attempt - 1)), MAX_BACKOFF)
+            time.sleep(wait_s + random.uniform(0.0, 0.8))
+
+
+def split_message(text, limit=TELEGRAM_MAX_LEN):
+    """
+    Suskaido tekstą per eilutes į dalis, kurių kiekviena telpa į vieną Telegram žinutę.
+    """
+    chunks = []
+    cur = []
+    cur_len = 0
+    for line in text.split("\n"):
+        line = line[:limit]
+        if cur and cur_len + 1 + len(line) > limit:
+            chunks.append("\n".join(cur))
+            cur = []
+            cur_len = 0
+        cur_len += len(line) + (1 if cur else 0)
+        cur.append(line)
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
+
 def send_telegram(text):
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         raise RuntimeError("Trūksta TELEGRAM_BOT_TOKEN arba TELEGRAM_CHAT_ID secrets")
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": text,
-        "disable_web_page_preview": True
-    }
-    r = requests.post(url, json=payload, timeout=20)
-    r.raise_for_status()
+    # Siunčiam paeiliui per tą pačią jungtį, kad dalys ateitų teisinga tvarka
+    for chunk in split_message(text):
+        payload = {
+            "chat_id": TELEGRAM_CHAT_ID,
+            "text": chunk,
+            "disable_web_page_preview": True
+        }
+        for attempt in range(1, MAX_RETRIES + 1):
+            r = SESSION.post(url, json=payload, timeout=20)
+            if r.status_code != 429 or attempt == MAX_RETRIES:
+                break
+            # Telegram flood limitas: parameters.retry_after nurodo, kiek laukti
+            try:
+                wait_s = float(r.json()["parameters"]["retry_after"])
+            except Exception:
+                wait_s = min(BASE_BACKOFF * (2 ** (attempt - 1)), MAX_BACKOFF)
+            time.sleep(wait_s + random.uniform(0.0, 0.8))
+        r.raise_for_status()
+
 
+# getcurrent type=4 filtruoja pagal prefiksą, todėl feed'e būna ir 424B2, 40-F ir pan.
+FORM4_TYPES = {"4", "4/A"}
 
-def get_latest_form4_feed(limit=MAX_NEW_FILINGS_TO_PROCESS):
+
+def entry_form_type(entry):
+    """
+    Atom entry formos tipas: <category term="4"/>, o jei jo nėra - pavadinimo
+    pradžia ("4/A - Vardas (CIK) (Reporting)").
+    """
+    category = entry.find("{*}category")
+    if category is not None and category.get("term"):
+        return category.get("term").strip()
+    title = entry.findtext("{*}title") or ""
+    return title.split(" - ", 1)[0].strip()
+
+
+def get_latest_form4_feed(con, limit=MAX_NEW_FILINGS_TO_PROCESS):
     """
     Paimam naujausius Form 4 filingus iš SEC Atom feed.
+    Conditional GET: jei feed nepasikeitė nuo praeito run (304), grąžinam [].
+    Grąžina (links, validators); validators (ETag/Last-Modified) čia nerašom -
+    kviečiantysis juos išsaugo kartu su run seen atnaujinimais.
     """
     feed_url = "https://www.sec.gov/cgi-bin/browse-edgar?action=getcurrent&type=4&output=atom"
-    r = sec_get(feed_url, timeout=30)
-    text = r.text
 
-    links = []
-    needle = 'href="'
-    idx = 0
-    while True:
-        idx = text.find(needle, idx)
-        if idx == -1:
-            break
-        idx += len(needle)
-        end = text.find('"', idx)
-        if end == -1:
-            break
-        href = text[idx:end]
-        idx = end + 1
+    headers = {}
+    etag = get_meta(con, "feed_etag")
+    last_modified = get_meta(con, "feed_last_modified")
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    r = sec_get(feed_url, timeout=30, headers=headers)
+    if r.status_code == 304:
+        return [], None
+
+    validators = {
+        "feed_etag": r.headers.get("ETag"),
+        "feed_last_modified": r.headers.get("Last-Modified"),
+    }
+
+    # dict kaip sutvarkytas set: unikalūs, išlaikom eilę, vienu perėjimu.
+    # Einam per Atom <entry>; apdorotą entry ir ankstesnius elementus išmetam,
+    # todėl atmintyje vienu metu tik vienas įrašas.
+    links = {}
+    for _, entry in etree.iterparse(io.BytesIO(r.content), events=("end",), tag="{*}entry"):
+        link = entry.find("{*}link")
+        href = link.get("href", "") if link is not None else ""
+        form_type = entry_form_type(entry)
+
+        entry.clear()
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
 
-        if "/Archives/edgar/data/" in href and href.endswith("-index.html"):
-            links.append(href)
+        if form_type in FORM4_TYPES and "/Archives/edgar/data/" in href and _filing_base(href):
+            links[href] = None
+            if len(links) >= limit:
+                break
 
-    # unikalūs, išlaikom eilę
-    seen = set()
-    uniq = []
-    for x in links:
-        if x not in seen:
-            uniq.append(x)
-            seen.add(x)
+    return list(links), validators
 
-    return uniq[:limit]
+
+def _filing_base(index_html_url):
+    """
+    .../{acc}-index.htm(l) -> .../{acc}; None, jei tai ne filingo index nuoroda.
+    """
+    for suffix in ("-index.html", "-index.htm"):
+        if index_html_url.endswith(suffix):
+            return index_html_url[:-len(suffix)]
+    return None
 
 
 def index_json_from_index_html(index_html_url):
-    if not index_html_url.endswith("-index.html"):
+    base = _filing_base(index_html_url)
+    if base is None:
         return None
-    base = index_html_url.rsplit("/", 1)[0]
-    return base + "/index.json"
+    return base.rsplit("/", 1)[0] + "/index.json"
+
+
+def submission_txt_from_index_html(index_html_url):
+    """
+    .../{cik}/{acc_nodash}/{acc}-index.html -> .../{cik}/{acc_nodash}/{acc}.txt
+    Pilnas submission failas, kuriame Form 4 XML įdėtas tarp <XML> žymų.
+    """
+    base = _filing_base(index_html_url)
+    if base is None:
+        return None
+    return base + ".txt"
+
+
+def extract_form4_xml(submission):
+    """
+    Iš submission .txt (bytes) ištraukiam ownershipDocument XML.
+    Grąžina bytes arba None, jei XML dokumento nėra.
+    """
+    idx = 0
+    while True:
+        start = submission.find(b"<XML>", idx)
+        if start == -1:
+            return None
+        end = submission.find(b"</XML>", start)
+        if end == -1:
+            return None
+        doc = submission[start + len(b"<XML>"):end].strip()
+        if b"<ownershipDocument" in doc:
+            return doc
+        idx = end
 
 
 def pick_primary_xml(index_json):
     """
-    Iš index.json paimam tikėtiną Form 4 XML failą.
+    Iš index.json paimam tikėtiną Form 4 XML failą: pirmenybė pavadinimui su
+    "form4", kitaip pirmas .xml. Vienas perėjimas, be tarpinio sąrašo.
     """
     files = index_json.get("directory", {}).get("item", [])
-    xml_candidates = [f["name"] for f in files if f.get("name", "").lower().endswith(".xml")]
-    if not xml_candidates:
-        return None
-    return xml_candidates[0]
+    first = None
+    for f in files:
+        name = f.get("name", "")
+        lower = name.lower()
+        if not lower.endswith(".xml"):
+            continue
+        if "form4" in lower:
+            return name
+        if first is None:
+            first = name
+    return first
+
+
+def _clean(text):
+    return (text.strip() or None) if text else None
+
+
+def _xpath_text(*steps):
+    """
+    Iš anksto sukompiliuota XPath užklausa vaiko tekstui.
+    local-name(), kad veiktų ir su namespace, ir be jo. Nerasta -> "".
+    """
+    path = "/".join(f"*[local-name()='{step}']" for step in steps)
+    return etree.XPath(f"string({path})", smart_strings=False)
+
+
+# Kompiliuojam vieną kartą modulio lygyje, vertinama C lygyje (libxml2)
+TXN_CODE = _xpath_text("transactionCoding", "transactionCode")
+TXN_SHARES = _xpath_text("transactionAmounts", "transactionShares", "value")
+TXN_PRICE = _xpath_text("transactionAmounts", "transactionPricePerShare", "value")
+TXN_DATE = _xpath_text("transactionDate", "value")
 
 
-def _txt(node):
-    return node.text.strip() if node is not None and node.text else None
+# Fiksuota Form 4 schema: iterparse grąžina tik šiuos elementus,
+# visa kita libxml2 praleidžia C lygyje be Python event'ų
+FORM4_TAG_KIND = {
+    "issuerTradingSymbol": "symbol",
+    "rptOwnerName": "owner",
+    "nonDerivativeTransaction": "txn",
+    "nonDerivativeTable": "table_end",
+}
+FORM4_TAGS = tuple("{*}" + name for name in FORM4_TAG_KIND)
 
 
-def parse_form4_xml_purchases(xml_text):
+# Pigus patikrinimas bytes lygyje: ar XML apskritai yra transactionCode P
+PURCHASE_CODE_RE = re.compile(rb"<(?:\w+:)?transactionCode>\s*P\s*</")
+
+
+def parse_form4_xml_purchases(xml_bytes):
     """
-    Tvirtas Form 4 XML parsingas:
+    Form 4 XML parsingas su lxml iterparse (vienas srautinis perėjimas):
     - paima issuerTradingSymbol
     - paima rptOwnerName
     - surenka VISAS nonDerivativeTransaction su transactionCode == "P"
+    Apdorotus elementus išvalom, todėl pilnas medis atmintyje nesikaupia.
     Grąžina: list[purchase], kur purchase turi symbol/owner/date/shares/price/code
     """
-    root = ET.fromstring(xml_text)
+    # Dauguma Form 4 - ne pirkimai (A, M, S, F...), jų XML nė neparsinam
+    if not PURCHASE_CODE_RE.search(xml_bytes):
+        return []
 
-    # issuerTradingSymbol
-    symbol = None
-    for el in root.iter():
-        if el.tag.endswith("issuerTradingSymbol"):
-            symbol = _txt(el)
-            break
+    symbol = owner = None
+    purchases = []
+    # pilnas tag (su namespace, jei yra) -> rūšis; namespace nuimam tik pirmą kartą
+    kinds = {}
+
+    for _, el in etree.iterparse(io.BytesIO(xml_bytes), events=("end",), tag=FORM4_TAGS):
+        kind = kinds.get(el.tag)
+        if kind is None:
+            kind = kinds[el.tag] = FORM4_TAG_KIND[el.tag.rpartition("}")[2]]
+
+        # kaip findtext: imam pirmą reikšmę (bendrame filinge pirmas reporting owner)
+        if kind == "symbol":
+            if symbol is None:
+                symbol = _clean(el.text)
+        elif kind == "owner":
+            if owner is None:
+                owner = _clean(el.text)
+        elif kind == "txn":
+            code = _clean(TXN_CODE(el))
+            if code == "P":
+                purchases.append({
+                    "symbol": symbol,
+                    "owner": owner,
+                    "code": code,
+                    "shares": _clean(TXN_SHARES(el)),
+                    "price": _clean(TXN_PRICE(el)),
+                    "date": _clean(TXN_DATE(el))
+                })
 
-    # owner name (rptOwnerName)
-    owner = None
-    for el in root.iter():
-        if el.tag.endswith("rptOwnerName"):
-            owner = _txt(el)
+            # atlaisvinam jau apdorotą transakciją ir ankstesnius kaimynus
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+        elif kind == "table_end":
+            # Schema: issuer ir owner eina prieš lentelę, derivativeTable ir
+            # footnotes po jos mums nereikalingi, todėl toliau neskaitom
             break
 
-    purchases = []
+    return purchases
 
-    # non-derivative transactions
-    for txn in root.iter():
-        if not txn.tag.endswith("nonDerivativeTransaction"):
-            continue
 
-        code = shares = price = tdate = None
-
-        for el in txn.iter():
-            if el.tag.endswith("transactionCode"):
-                code = _txt(el)
-            elif el.tag.endswith("transactionShares"):
-                shares = _txt(el)
-            elif el.tag.endswith("transactionPricePerShare"):
-                price = _txt(el)
-            elif el.tag.endswith("transactionDate"):
-                tdate = _txt(el)
-
-        if code == "P":
-            purchases.append({
-                "symbol": symbol,
-                "owner": owner,
-                "code": code,
-                "shares": shares,
-                "price": price,
-                "date": tdate
-            })
+def parse_form4_xml_safe(xml_bytes):
+    """
+    ProcessPool'ui: klaidą grąžinam kaip tekstą, kad viena bloga XML nenutrauktų map().
+    Grąžina (purchases, None) arba (None, klaidos tekstas).
+    """
+    try:
+        return parse_form4_xml_purchases(xml_bytes), None
+    except Exception as e:
+        return None, str(e)
 
-    return purchases
 
+# fetch_form4_xml/process_filing rezultatas, kai index.json ar XML viršija ribą.
+# Dydis filingui nesikeičia, todėl tai ne klaida kartoti, o praleidžiamas filingas.
+OVERSIZED = object()
 
-def main():
-    db = load_db()
-    now = dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-    db["last_run_utc"] = now
 
+def fetch_form4_xml(index_html):
+    """
+    Form 4 XML viena užklausa: imam pilną submission .txt (URL žinomas iš
+    index nuorodos) vietoj index.json + XML. Jei ten XML nėra, grįžtam
+    prie senojo kelio per index.json.
+    Grąžina bytes, None (XML nėra) arba OVERSIZED.
+    """
+    submission = sec_get_bytes(submission_txt_from_index_html(index_html), SUBMISSION_MAX_BYTES)
+    # per didelis .txt (pvz. su stambiais priedais) -> einam per index.json tiesiai į XML
+    if submission is not None:
+        xml_bytes = extract_form4_xml(submission)
+        if xml_bytes is not None:
+            return xml_bytes
+
+    index_json_url = index_json_from_index_html(index_html)
+    index_bytes = sec_get_bytes(index_json_url, INDEX_JSON_MAX_BYTES)
+    if index_bytes is None:
+        return OVERSIZED
+    xml_name = pick_primary_xml(orjson.loads(index_bytes))
+    if not xml_name:
+        return None
+
+    base = index_json_url.rsplit("/", 1)[0]
+    xml_url = base + "/" + xml_name
+
+    # Form 4 XML paprastai < 100 KB; milžiniškus praleidžiam (ataskaitoje lieka nuoroda)
+    xml_bytes = sec_get_bytes(xml_url, FORM4_XML_MAX_BYTES)
+    if xml_bytes is None:
+        return OVERSIZED
+    return xml_bytes
+
+
+def purchases_to_items(purchases, link):
+    """
+    Iš vieno filingo P transakcijų padarom ataskaitos įrašus (arba [], jei netinka).
+    """
+    # Filtras: tik jei nėra nė vieno P, atmetam
+    if ONLY_PURCHASES and not purchases:
+        return []
+
+    sym = (purchases[0].get("symbol") or "").strip()
+    if not sym:
+        return []
+
+    # Įdedam visas P transakcijas iš šito filing'o
+    return [{
+        "symbol": sym,
+        "owner": p.get("owner"),
+        "date": p.get("date"),
+        "shares": p.get("shares"),
+        "price": p.get("price"),
+        "code": p.get("code"),
+        "link": link
+    } for p in purchases]
+
+
+def process_filing(index_html):
+    """
+    Vienas filingas: Form 4 XML -> P transakcijos.
+    Grąžina list[item] (tuščias, jei nieko įdomaus) arba OVERSIZED.
+    Klaidos keliauja aukštyn.
+    """
+    xml_bytes = fetch_form4_xml(index_html)
+    if xml_bytes is None:
+        return []
+    if xml_bytes is OVERSIZED:
+        return OVERSIZED
+
+    return purchases_to_items(parse_form4_xml_purchases(xml_bytes), index_html)
+
+
+BULK_TYPE_RE = re.compile(rb"<TYPE>4(?:/A)?\s")  # kaip ir feed'e: 4 ir 4/A
+BULK_ACCESSION_RE = re.compile(rb"<ACCESSION-NUMBER>\s*([\d-]+)")
+BULK_CIK_RE = re.compile(rb"<CIK>\s*(\d+)")
+
+
+def bulk_feed_url(day):
+    quarter = (day.month - 1) // 3 + 1
+    return f"https://www.sec.gov/Archives/edgar/Feed/{day.year}/QTR{quarter}/{day:%Y%m%d}.nc.tar.gz"
+
+
+def previous_business_day(today):
+    day = today - dt.timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= dt.timedelta(days=1)
+    return day
+
+
+def get_daily_form4_bulk(day):
+    """
+    Srautu perskaitom dienos archyvą ir surenkam Form 4 submission'us.
+    Grąžina dict: accession (be brūkšnelių) -> (index nuoroda, XML bytes);
+    tuščią, jei tai dienai archyvo nėra (SEC šventė).
+    """
+    filings = {}
+    r = sec_get(bulk_feed_url(day), timeout=120, stream=True, ok_statuses=(200, 404))
+    with r:
+        # Švenčių dienomis SEC archyvo nebūna - tai ne klaida, tiesiog nėra filingų
+        if r.status_code == 404:
+            return filings
+        with tarfile.open(fileobj=r.raw, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                f = tar.extractfile(member)
+                # Antraštė trumpa: tipą matom iš pradžios, kitų formų nė neskaitom
+                head = f.read(4096)
+                if not BULK_TYPE_RE.search(head):
+                    continue
+                acc = BULK_ACCESSION_RE.search(head)
+                cik = BULK_CIK_RE.search(head)
+                if not acc or not cik:
+                    continue
+
+                xml_bytes = extract_form4_xml(head + f.read())
+                if xml_bytes is None:
+                    continue
+
+                accession = acc.group(1).decode()
+                acc_nodash = accession.replace("-", "")
+                link = f"https://www.sec.gov/Archives/edgar/data/{int(cik.group(1))}/{acc_nodash}/{accession}-index.htm"
+                filings.setdefault(acc_nodash, (link, xml_bytes))
+
+    return filings
+
+
+def scan_feed(con, now):
+    """
+    Realtime kelias: Atom feed -> nauji filingai -> lygiagretus fetch.
+    Grąžina (new_items, failed, last_err, oversized), kur oversized -
+    praleistų per didelių filingų nuorodos.
+    """
     new_items = []
     failed = 0
     last_err = None
+    oversized = []
 
-    index_links = get_latest_form4_feed(limit=MAX_NEW_FILINGS_TO_PROCESS)
+    index_links, validators = get_latest_form4_feed(con, limit=MAX_NEW_FILINGS_TO_PROCESS)
 
+    # accession -> index nuoroda. Tas pats filingas feed'e būna po kartą kiekvienam
+    # filer'iui (Issuer ir Reporting), tad vienam accession darom vieną fetch'ą.
+    todo = {}
     for index_html in index_links:
-        index_json_url = index_json_from_index_html(index_html)
-        if not index_json_url:
+        if not index_json_from_index_html(index_html):
             continue
 
-        accession = index_html.split("/")[-2] if len(index_html.split("/")) >= 2 else index_html
+        # .../data/{cik}/{acc_nodash}/{acc}-index.htm -> acc_nodash, vienas rsplit
+        accession = index_html.rsplit("/", 2)[-2]
 
-        if accession in db.get("seen_accessions", []):
-            continue
+        todo.setdefault(accession, index_html)
 
-        try:
-            j = sec_get(index_json_url, timeout=30).json()
-            xml_name = pick_primary_xml(j)
-            if not xml_name:
-                db["seen_accessions"].append(accession)
-                continue
+    # Ką praeitas run jau parsino, imam iš cache, o ne iš SEC
+    done = parsed_pending(con)
 
-            base = index_json_url.rsplit("/", 1)[0]
-            xml_url = base + "/" + xml_name
+    # jau matytus atsijojam viena užklausa visam feed'ui
+    seen = seen_among(con, list(todo))
+    todo = {acc: link for acc, link in todo.items() if acc not in seen and acc not in done}
 
-            xml_text = sec_get(xml_url, timeout=30).text
-            purchases = parse_form4_xml_purchases(xml_text)
+    # Tinklo laukimas dominuoja, todėl filingus traukiam lygiagrečiai.
+    # Rezultatus renkam pateikimo tvarka, kad ataskaita liktų deterministinė.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [(accession, index_html, pool.submit(process_filing, index_html)) for accession, index_html in todo.items()]
 
-            # Filtras: tik jei nėra nė vieno P, atmetam
-            if ONLY_PURCHASES and not purchases:
-                db["seen_accessions"].append(accession)
+        for accession, index_html, fut in futures:
+            try:
+                items = fut.result()
+            except Exception as e:
+                failed += 1
+                last_err = str(e)
+                # nekrentam iš viso run, tęsiam
                 continue
+            if items is OVERSIZED:
+                # kartoti nėra prasmės: žymim seen be įrašų, bet parodom ataskaitoje
+                oversized.append(index_html)
+                items = []
+            cache_parsed(con, accession, items)
+            done[accession] = items
 
-            sym = (purchases[0].get("symbol") or "").strip()
-            if not sym:
-                db["seen_accessions"].append(accession)
-                continue
+    # seen žymim tik visiems baigus, kartu su vienu commit main() gale
+    for accession, items in done.items():
+        new_items.extend(items)
+        mark_seen(con, accession, now)
 
-            # Įdedam visas P transakcijas iš šito filing'o
-            for p in purchases:
-                new_items.append({
-                    "symbol": sym,
-                    "owner": p.get("owner"),
-                    "date": p.get("date"),
-                    "shares": p.get("shares"),
-                    "price": p.get("price"),
-                    "code": p.get("code"),
-                    "link": index_html
-                })
+    # Validatorius rašom tik po visų cache_parsed commit'ų, kad jie patektų
+    # į tą patį main() commit'ą kaip ir seen. Jei kuris filingas nepavyko,
+    # senų nekeičiam: kitas run gaus 200 (ne 304) ir jį pakartos.
+    if validators and not failed:
+        for key, value in validators.items():
+            set_meta(con, key, value)
 
-            db["seen_accessions"].append(accession)
+    return new_items, failed, last_err, oversized
 
-        except Exception as e:
-            failed += 1
-            last_err = str(e)
-            # nekrentam iš viso run, tęsiam
+
+def scan_bulk(con, now, day):
+    """
+    Bulk kelias: vienas dienos archyvas vietoj N+1 užklausų.
+    Grąžina (new_items, failed, last_err, oversized) - kaip scan_feed;
+    archyve XML jau turim, tad oversized visada tuščias.
+    """
+    new_items = []
+    failed = 0
+    last_err = None
+
+    try:
+        filings = get_daily_form4_bulk(day)
+    except Exception as e:
+        return new_items, 1, str(e), []
+
+    seen = seen_among(con, list(filings))
+
+    # Be P kodo XML net nesiunčiam į procesus - tik pažymim seen
+    todo = []
+    for accession, (link, xml_bytes) in filings.items():
+        if accession in seen:
             continue
+        if PURCHASE_CODE_RE.search(xml_bytes):
+            todo.append((accession, link, xml_bytes))
+        else:
+            mark_seen(con, accession, now)
+
+    # Dienos archyve tūkstančiai filingų: parsingas CPU darbas, skirstom per branduolius
+    with ProcessPoolExecutor() as pool:
+        results = pool.map(parse_form4_xml_safe, [x for _, _, x in todo], chunksize=8)
+        for (accession, link, _), (purchases, err) in zip(todo, results):
+            if err is not None:
+                failed += 1
+                last_err = err
+                continue
+            new_items.extend(purchases_to_items(purchases, link))
+            mark_seen(con, accession, now)
+
+    return new_items, failed, last_err, []
 
-    # apribojam db dydį
-    db["seen_accessions"] = db.get("seen_accessions", [])[-2500:]
-    save_db(db)
+
+def main():
+    con = open_db()
+    utc_now = dt.datetime.now(dt.timezone.utc)
+    now = utc_now.strftime("%Y-%m-%dT%H:%M:%SZ")
+    set_meta(con, "last_run_utc", now)
+
+    if USE_BULK:
+        new_items, failed, last_err, oversized = scan_bulk(con, now, previous_business_day(utc_now.date()))
+    else:
+        new_items, failed, last_err, oversized = scan_feed(con, now)
+
+    # apribojam db dydį, vienas commit visam run
+    prune_seen(con)
+    drop_parsed_seen(con)
+    con.commit()
+    con.close()
 
     if not new_items:
         msg = f"Radaras patikrintas {now}\nNaujų insider pirkimų nerasta"
         if failed and last_err:
             msg += f"\nPastaba: buvo klaidų (pvz. {last_err[:120]})"
+        if oversized:
+            msg += f"\nPraleisti per dideli filingai ({len(oversized)}):\n" + "\n".join(oversized)
         send_telegram(msg)
         return
 
-    # grupuojam pagal tickerį
+    # grupuojam pagal tickerį; insiderių set'ą kaupiam tame pačiame perėjime
     by_sym = {}
     for it in new_items:
-        by_sym.setdefault(it["symbol"], []).append(it)
+        b = by_sym.setdefault(it["symbol"], {"items": [], "owners": set()})
+        b["items"].append(it)
+        owner = (it.get("owner") or "").strip()
+        if owner:
+            b["owners"].add(owner)
 
     lines = [f"Radaras patikrintas {now}", "Nauji insider pirkimai"]
-    for sym in sorted(by_sym.keys()):
-        items = by_sym[sym]
+    # lokalus binding'as karštam ciklui; tekstas sujungiamas vieną kartą gale
+    add = lines.append
+    for sym in sorted(by_sym):
+        b = by_sym[sym]
+        items = b["items"]
         last = items[0]
 
-        owners = sorted({(x.get('owner') or '').strip() for x in items if x.get('owner')})
-        owners_txt = ", ".join([o for o in owners if o])[:140]
+        owners_txt = ", ".join(sorted(b["owners"]))[:140]
 
-        lines.append("")
-        lines.append(f"{sym} | įrašų {len(items)}")
+        add("")
+        add(f"{sym} | įrašų {len(items)}")
         if owners_txt:
-            lines.append(f"Insider: {owners_txt}")
+            add(f"Insider: {owners_txt}")
         if last.get("date"):
-            lines.append(f"Data: {last.get('date')}")
+            add(f"Data: {last.get('date')}")
         if last.get("shares") or last.get("price"):
             s = last.get("shares") or "-"
             p = last.get("price") or "-"
-            lines.append(f"Kiekis: {s} | Kaina: {p}")
-        lines.append(f"Nuoroda: {last.get('link')}")
+            add(f"Kiekis: {s} | Kaina: {p}")
+        add(f"Nuoroda: {last.get('link')}")
 
     if failed:
-        lines.append("")
-        lines.append("Pastaba: dalis užklausų buvo apribotos arba nepavyko, bet radaras veikė")
+        add("")
+        add("Pastaba: dalis užklausų buvo apribotos arba nepavyko, bet radaras veikė")
+
+    if oversized:
+        add("")
+        add(f"Praleisti per dideli filingai ({len(oversized)}), patikrink rankiniu būdu:")
+        for link in oversized:
+            add(link)
 
     send_telegram("\n".join(lines))
 